@@ -1,9 +1,19 @@
+import io
+import os
 import re
+import shutil
+import time
+import hashlib
+import tempfile
+import functools
+import threading
 import requests
+import google_auth_httplib2
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import HttpRequest, MediaFileUpload, MediaIoBaseUpload, build_http
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
@@ -13,29 +23,124 @@ from urllib3.util.retry import Retry
 SCOPES = ['https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'service_account.json'
 
-# Initialize Drive client with specified permissions
-creds = Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE,
-    scopes=SCOPES
-)
-drive_service = build('drive', 'v3', credentials=creds)
+# httplib2 connections are not thread-safe: give each thread its own
+# authorized connection so Drive calls can run concurrently from worker threads
+_thread_local = threading.local()
+
+
+@functools.cache
+def _credentials():
+    """Load the service account credentials with the specified permissions."""
+    return Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_FILE,
+        scopes=SCOPES
+    )
+
+
+def _thread_http():
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        # build_http keeps the client's defaults: a socket timeout, and 308
+        # (resumable-upload "incomplete") not treated as a redirect
+        http = google_auth_httplib2.AuthorizedHttp(_credentials(), http=build_http())
+        _thread_local.http = http
+    return http
+
 
-# Setup HTTP session with retry logic for downloads
+def _build_request(http, *args, **kwargs):
+    return HttpRequest(_thread_http(), *args, **kwargs)
+
+
+_drive_service = None
+_drive_lock = threading.Lock()
+
+
+def _drive():
+    """Build the Drive client on first use and reuse it for the process lifetime."""
+    global _drive_service
+    if _drive_service is None:
+        # Concurrent upload threads may race here; only one builds the client
+        with _drive_lock:
+            if _drive_service is None:
+                _drive_service = build(
+                    'drive', 'v3',
+                    credentials=_credentials(),
+                    requestBuilder=_build_request,
+                    # Use the discovery document bundled with the client library
+                    static_discovery=True,
+                    cache_discovery=False
+                )
+    return _drive_service
+
+# Setup pooled HTTP session with retry logic, shared by all outbound HTTP calls
 session = requests.Session()
 retries = Retry(
     total=3,
     backoff_factor=1,
-    status_forcelist=[500, 502, 503, 504],
+    status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["GET", "POST"]
 )
-adapter = HTTPAdapter(max_retries=retries)
+adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries)
 session.mount('https://', adapter)
 session.mount('http://', adapter)
 
+# Pooled session for non-idempotent POSTs (report generation): only failed
+# connection attempts, which never reach the server, are retried; 5xx and
+# read timeouts are not, so a report build is never sent twice
+post_session = requests.Session()
+post_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=1)
+)
+post_session.mount('https://', post_adapter)
+post_session.mount('http://', post_adapter)
+
+# Directories already created by this process
+_created_dirs = set()
+_created_dirs_lock = threading.Lock()
+
+
+def ensure_dir(path: str) -> None:
+    """
+    Create a directory (and parents) once per process.
+    Repeat calls for the same path skip the makedirs syscalls.
+    """
+    if path in _created_dirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    with _created_dirs_lock:
+        _created_dirs.add(path)
+
+# Stream downloads in 1 MiB chunks
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Resumable upload chunk size; must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Files up to this size go in a single request, skipping the resumable session
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+
+# Opt-in: exported input sheets are kept by URL hash and reused for this many
+# seconds. Sheets are live documents, so a cached export can be stale; 0 (the
+# default) disables the cache
+DOWNLOAD_CACHE_TTL = int(os.getenv("MARKET_GAP_DOWNLOAD_CACHE_TTL", "0"))
+DOWNLOAD_CACHE_DIR = os.getenv(
+    "MARKET_GAP_DOWNLOAD_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "mga_cache")
+)
+
+# Upload MIME types by extension; others are guessed from the file name
+_MIME_BY_EXT = {
+    '.docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    '.xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    '.pptx': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    '.png': 'image/png',
+}
+
 def download_sheet_as_xlsx(drive_url: str, download_dir: str) -> str:
     """
     Download a Google Sheets file (given its webView URL) as a .xlsx file.
-    Uses streaming, retry logic, and timeout to handle large files and transient errors.
+    Streams the export to disk with retry logic and a timeout to handle large
+    files and transient errors.
     """
     m = re.search(r'/d/([a-zA-Z0-9_-]+)', drive_url)
     if not m:
@@ -43,17 +148,104 @@ def download_sheet_as_xlsx(drive_url: str, download_dir: str) -> str:
     file_id = m.group(1)
 
     export_url = f"https://docs.google.com/spreadsheets/d/{file_id}/export?format=xlsx"
-    resp = session.get(export_url, timeout=30, stream=True)
-    resp.raise_for_status()
-
-    Path(download_dir).mkdir(parents=True, exist_ok=True)
+    ensure_dir(download_dir)
     out_path = Path(download_dir) / f"{file_id}.xlsx"
-    # Stream response to file in chunks
-    with open(out_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
-    return str(out_path)
+    return download_to_file(export_url, str(out_path), timeout=30, cache=True)
+
+
+def _cache_path(url: str) -> str:
+    return os.path.join(DOWNLOAD_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest())
+
+
+def _cached_copy(url: str):
+    """Return the cache path for url if a fresh copy exists, else None."""
+    if DOWNLOAD_CACHE_TTL <= 0:
+        return None
+    path = _cache_path(url)
+    try:
+        if time.time() - os.path.getmtime(path) < DOWNLOAD_CACHE_TTL:
+            return path
+    except OSError:
+        pass
+    return None
+
+
+def _evict_expired() -> None:
+    """Delete cache entries (and stale temp files) older than the TTL."""
+    cutoff = time.time() - DOWNLOAD_CACHE_TTL
+    try:
+        entries = list(os.scandir(DOWNLOAD_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            # Already removed or replaced by another thread
+            pass
+
+
+def _store_in_cache(url: str, src_path: str) -> None:
+    if DOWNLOAD_CACHE_TTL <= 0:
+        return
+    path = _cache_path(url)
+    ensure_dir(DOWNLOAD_CACHE_DIR)
+    _evict_expired()
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.copyfile(src_path, tmp)
+    # Atomic, so concurrent readers never see a partial file
+    os.replace(tmp, path)
+
+
+def download_to_file(url: str, dest_path: str, timeout: int = 60, cache: bool = False) -> str:
+    """
+    Stream a URL to dest_path through the shared session without buffering
+    the body in memory. With cache=True, a copy downloaded within
+    DOWNLOAD_CACHE_TTL seconds is reused instead. Returns dest_path.
+    """
+    if not cache:
+        return _fetch(url, dest_path, timeout)
+    cached = _cached_copy(url)
+    if cached:
+        shutil.copyfile(cached, dest_path)
+        return dest_path
+    _fetch(url, dest_path, timeout)
+    try:
+        _store_in_cache(url, dest_path)
+    except OSError:
+        pass
+    return dest_path
+
+
+def _fetch(url: str, dest_path: str, timeout: int) -> str:
+    with session.get(url, timeout=timeout, stream=True) as resp:
+        resp.raise_for_status()
+        # Copy the raw socket stream straight to disk
+        resp.raw.decode_content = True
+        with open(dest_path, 'wb') as f:
+            shutil.copyfileobj(resp.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+    return dest_path
+
+
+def iter_sheet_downloads(drive_urls: list, download_dir: str, max_workers: int = 8):
+    """
+    Download several Google Sheets files concurrently as .xlsx files.
+    Yields (index, local_path) pairs as each download completes, so callers
+    can start parsing a file while the others are still downloading.
+    """
+    if not drive_urls:
+        return
+    if len(drive_urls) == 1:
+        yield 0, download_sheet_as_xlsx(drive_urls[0], download_dir)
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(drive_urls))) as ex:
+        futures = {
+            ex.submit(download_sheet_as_xlsx, url, download_dir): i
+            for i, url in enumerate(drive_urls)
+        }
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
 
 
 def list_files_by_id(folder_id: str) -> list:
@@ -64,7 +256,7 @@ def list_files_by_id(folder_id: str) -> list:
     files = []
     page_token = None
     while True:
-        resp = drive_service.files().list(
+        resp = _drive().files().list(
             q=f"'{folder_id}' in parents and trashed=false",
             fields='nextPageToken, files(id,name,webViewLink,webContentLink)',
             pageToken=page_token
@@ -76,24 +268,59 @@ def list_files_by_id(folder_id: str) -> list:
     return files
 
 
-def upload_to_drive(file_path: str, drive_folder_id: str) -> str:
+def upload_to_drive(file_path, drive_folder_id: str) -> str:
     """
-    Upload a local file to the specified Drive folder.
-    Automatically sets MIME type for .docx/.pptx and returns new file ID.
+    Upload a local file, or an in-memory BytesIO with a .name, to the
+    specified Drive folder; files larger than RESUMABLE_THRESHOLD use a
+    resumable upload.
+    Automatically sets MIME type for Office files and charts and returns new file ID.
     """
-    file_name = Path(file_path).name
-    if file_name.endswith('.docx'):
-        mime_type = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
-    elif file_name.endswith('.pptx'):
-        mime_type = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+    in_memory = isinstance(file_path, io.BytesIO)
+    file_name = Path(file_path.name if in_memory else file_path).name
+    mime_type = _MIME_BY_EXT.get(Path(file_name).suffix.lower())
+    if in_memory:
+        resumable = file_path.getbuffer().nbytes > RESUMABLE_THRESHOLD
+        media = MediaIoBaseUpload(
+            file_path,
+            mimetype=mime_type or 'application/octet-stream',
+            chunksize=UPLOAD_CHUNK_SIZE if resumable else -1,
+            resumable=resumable
+        )
     else:
-        mime_type = None
-
-    media = MediaFileUpload(file_path, mimetype=mime_type) if mime_type else MediaFileUpload(file_path)
+        resumable = os.path.getsize(file_path) > RESUMABLE_THRESHOLD
+        media = MediaFileUpload(
+            file_path,
+            mimetype=mime_type,
+            chunksize=UPLOAD_CHUNK_SIZE if resumable else -1,
+            resumable=resumable
+        )
     metadata = {'name': file_name, 'parents': [drive_folder_id]}
-    created = drive_service.files().create(
+    req = _drive().files().create(
         body=metadata,
         media_body=media,
         fields='id'
-    ).execute()
+    )
+    if not resumable:
+        # Small file: one multipart request, no session initiation round trip.
+        # Not retried: files().create is not idempotent, and a retry after a
+        # 5xx or timeout that did reach Drive would create a duplicate file
+        return req.execute().get('id')
+    # Resumable upload: a failed chunk is retried without restarting the file
+    created = None
+    while created is None:
+        _, created = req.next_chunk(num_retries=3)
     return created.get('id')
+
+
+def upload_files_to_drive(file_paths: list, drive_folder_id: str, max_workers: int = 4) -> list:
+    """
+    Upload several local files (or named BytesIO buffers) to the specified
+    Drive folder concurrently.
+    Returns the new file IDs in the same order as file_paths.
+    """
+    if not file_paths:
+        return []
+    if len(file_paths) == 1:
+        return [upload_to_drive(file_paths[0], drive_folder_id)]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as ex:
+        return list(ex.map(lambda path: upload_to_drive(path, drive_folder_id), file_paths))
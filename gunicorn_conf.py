@@ -0,0 +1,20 @@
+import os
+
+# Production server settings:
+#   gunicorn -c gunicorn_conf.py market_gap_app:app
+# gthread workers handle concurrent requests without spawning a thread per
+# request; preload_app imports pandas/matplotlib/openai once in the parent.
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = 16
+preload_app = True
+keepalive = 60
+timeout = 120
+
+
+def when_ready(server):
+    # Runs in the parent before workers fork: pay matplotlib's import and
+    # font-cache load once instead of on each worker's first chart
+    from visualization import warm_up
+    warm_up()
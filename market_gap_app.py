@@ -1,11 +1,37 @@
 import os
-import json
+import re
+import atexit
+import queue
 import logging
+import tempfile
 import threading
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
-from market_gap_process import process_market_gap
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from market_gap_process import process_market_gap, inventory_kind
+from drive_utils import ensure_dir
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (keys are emitted unsorted)."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Reject oversized bodies with 413 before they are buffered; multipart
+# spreadsheet uploads need more room than JSON payloads
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_CONTENT_LENGTH", 16 * 1024 * 1024))
 
 @app.route("/healthz", methods=["GET"])
 def health_check():
@@ -15,18 +41,225 @@ def health_check():
 def health():
     return "✅ Market GAP Analysis API is live", 200
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+# Request and job threads only enqueue log records; a single listener
+# thread formats them and writes to stderr
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+_log_listener = None
+
+
+def start_log_listener():
+    global _log_listener
+    _log_listener = QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+
+
+_queue_handler = QueueHandler(_log_queue)
+# Records are pre-rendered (with any traceback) before being queued
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+start_log_listener()
+# Threads do not survive fork: gunicorn workers (preload_app) start their own
+os.register_at_fork(after_in_child=start_log_listener)
+atexit.register(lambda: _log_listener.stop())
 
 # Directory for staging
 BASE_DIR = "temp_sessions"
 os.makedirs(BASE_DIR, exist_ok=True)
 
+# Per-session job status, written by the handler and the background worker
+JOB_STATUS_FILE = "status.json"
+# Present (holding the owner's pid) while a job for the session is queued or running
+JOB_LOCK_FILE = "job.lock"
+
+# Bounded pool for background processing jobs
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("MARKET_GAP_WORKERS", 8)),
+    thread_name_prefix="gap"
+)
+atexit.register(EXECUTOR.shutdown, wait=False)
+
+# Admission control: running + queued jobs allowed before answering 503
+MAX_PENDING_JOBS = int(os.environ.get("MARKET_GAP_MAX_PENDING", 32))
+_job_slots = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+
+
+def submit_job(fn, *args):
+    """Submit a job to EXECUTOR, or return None when the backlog is full."""
+    if not _job_slots.acquire(blocking=False):
+        return None
+    future = EXECUTOR.submit(fn, *args)
+    future.add_done_callback(lambda _: _job_slots.release())
+    return future
+
+# Flat payloads send file_{n}_drive_url keys instead of a files array
+_FILE_KEY = re.compile(r"^file_(\d+)_drive_url$")
+MAX_FILES = 20
+
+
+def files_from_url_keys(data):
+    """Build the files array from file_{n}_drive_url keys, ordered by n."""
+    slots = [None] * (MAX_FILES + 1)
+    for key, url in data.items():
+        m = _FILE_KEY.match(key)
+        if m and url:
+            n = int(m.group(1))
+            if n <= MAX_FILES:
+                slots[n] = {
+                    'file_name': data.get(f"file_{n}_name") or f"file_{n}",
+                    'drive_url': url
+                }
+    return [f for f in slots if f]
+
+
+# session_id names folders on disk: no separators, dots or other specials
+_SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+def session_id_error(session_id):
+    """Return an error message for a missing or unsafe session_id, else None."""
+    if not session_id:
+        return "Missing session_id"
+    if not isinstance(session_id, str):
+        return "session_id must be a string"
+    if not _SESSION_ID.match(session_id):
+        return "session_id may only contain letters, digits, '_' and '-' (max 128)"
+    return None
+
+
+def validate_start_request(session_id, folder_id, files, uploaded=False):
+    """
+    Return an error message for an invalid /start_market_gap payload, else None.
+    Only multipart uploads (uploaded=True) may carry local_path entries: the
+    paths are staged by the server and never taken from the client.
+    """
+    error = session_id_error(session_id)
+    if error:
+        return error
+    if not folder_id:
+        return "Missing folder_id"
+    if not isinstance(folder_id, str):
+        return "folder_id must be a string"
+    if not files:
+        return "No files provided"
+    if not isinstance(files, list):
+        return "files must be an array"
+    for f in files:
+        if not isinstance(f, dict) or not isinstance(f.get('file_name'), str):
+            return "Each file needs a file_name"
+        if 'local_path' in f and not uploaded:
+            return f"File {f['file_name']}: local_path cannot be set by the client"
+        if not (f.get('drive_url') or f.get('local_path')):
+            return f"File {f['file_name']} has no drive_url"
+        if f.get('drive_url') and not isinstance(f['drive_url'], str):
+            return f"File {f['file_name']} drive_url must be a string"
+    # Only hw/sw inventories (classified by file name) are analyzed
+    if not any(inventory_kind(f['file_name']) for f in files):
+        return "No hw or sw inventory file provided (set file_{n}_name, e.g. hw_inventory.xlsx)"
+    return None
+
+
+def session_folder_name(session_id):
+    return session_id if session_id.startswith("Temp_") else f"Temp_{session_id}"
+
+
+def write_job_status(folder_path, status, **details):
+    """Atomically write the job status file polled by /jobs/<session_id>."""
+    # A unique temp file per write: concurrent writers never share one
+    fd, tmp_path = tempfile.mkstemp(dir=folder_path, prefix=f"{JOB_STATUS_FILE}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(orjson.dumps({"status": status, **details}))
+        os.replace(tmp_path, os.path.join(folder_path, JOB_STATUS_FILE))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _lock_holder_alive(path):
+    try:
+        with open(path) as fh:
+            pid = int(fh.read())
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # Just created; its holder has not written the pid yet
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claim_session(folder_path):
+    """
+    Mark the session as having a job queued or running. Returns False when a
+    live process already holds it; a lock left by a dead worker is taken over.
+    """
+    path = os.path.join(folder_path, JOB_LOCK_FILE)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if _lock_holder_alive(path):
+                return False
+            release_session(folder_path)
+            continue
+        with os.fdopen(fd, "w") as fh:
+            fh.write(str(os.getpid()))
+        return True
+    return False
+
+
+def release_session(folder_path):
+    try:
+        os.remove(os.path.join(folder_path, JOB_LOCK_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def run_market_gap_job(session_id, email, files, folder_id):
+    """Background job: prepare the session folder, run the analysis, record status."""
+    folder_path = os.path.join(BASE_DIR, session_folder_name(session_id))
+    try:
+        ensure_dir(folder_path)
+        write_job_status(folder_path, "running")
+        result = process_market_gap(session_id, email, files, folder_path, folder_id)
+        if result.get('error'):
+            write_job_status(folder_path, "failed", error=result['error'])
+        else:
+            write_job_status(folder_path, "completed", report_urls=result.get('report_urls', []))
+    except Exception as e:
+        logging.exception("🔥 Error in Market GAP processing thread")
+        try:
+            write_job_status(folder_path, "failed", error=str(e))
+        except OSError:
+            pass
+    finally:
+        release_session(folder_path)
+
+@app.route("/jobs/<session_id>", methods=["GET"])
+def job_status(session_id):
+    path = safe_join(BASE_DIR, session_folder_name(session_id), JOB_STATUS_FILE)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": f"No job found for {session_id}"}), 404
+    with open(path, "rb") as fh:
+        return jsonify(orjson.loads(fh.read())), 200
+
 @app.route("/start_market_gap", methods=["POST"])
 def start_market_gap():
     try:
         # try to parse JSON first (e.g. from tests)
+        uploaded = not request.is_json
+        uploads = []
         if request.is_json:
             data = request.get_json()
+            if not isinstance(data, dict):
+                return jsonify({"error": "Request body must be a JSON object"}), 400
         else:
             # fall back to multipart/form-data (file uploads from Postman)
             data = {
@@ -35,61 +268,87 @@ def start_market_gap():
                 'folder_id': request.form['folder_id'],
                 'files': []
             }
-            # save each uploaded file locally and record its path
+            # record where each uploaded file will be staged; nothing is
+            # written until the whole request has been validated
             tmp_dir = os.path.join('/tmp', data['session_id'])
-            os.makedirs(tmp_dir, exist_ok=True)
             for f in request.files.getlist('files'):
-                dest_path = os.path.join(tmp_dir, f.filename)
-                f.save(dest_path)
+                file_name = secure_filename(f.filename or '')
+                if not file_name:
+                    return jsonify({"error": f"Invalid upload file name: {f.filename!r}"}), 400
+                dest_path = os.path.join(tmp_dir, file_name)
+                uploads.append((f, dest_path))
                 data['files'].append({
-                    'file_name': f.filename,
+                    'file_name': file_name,
                     'local_path': dest_path
                 })
 
         # incoming files array and charts
-        files      = data.get('files') or []
+        files      = data.get('files') or files_from_url_keys(data)
         charts     = data.get('charts') or {}
         session_id = data.get('session_id')
         email      = data.get('email', '')
         folder_id  = data.get('folder_id')
 
-        logging.info("📦 Incoming payload:\n%s", json.dumps(data, indent=2))
-
-        # Validate required fields
-        if not session_id:
-            logging.error("❌ Missing session_id")
-            return jsonify({"error": "Missing session_id"}), 400
-        if not folder_id:
-            logging.error("❌ Missing folder_id")
-            return jsonify({"error": "Missing folder_id"}), 400
-        if not files:
-            logging.error("❌ No files provided")
-            return jsonify({"error": "No files provided"}), 400
-
-        # Prepare local session folder for staging
-        folder_name = session_id if session_id.startswith("Temp_") else f"Temp_{session_id}"
-        folder_path = os.path.join(BASE_DIR, folder_name)
-        os.makedirs(folder_path, exist_ok=True)
-
-        # Launch background processing thread
-        def runner():
-            try:
-                process_market_gap(session_id, email, files, folder_path, folder_id)
-            except Exception:
-                logging.exception("🔥 Error in Market GAP processing thread")
-
-        threading.Thread(target=runner, daemon=True).start()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("📦 Incoming payload: %s", orjson.dumps(data).decode())
+
+        # Validate required fields before anything is queued
+        error = validate_start_request(session_id, folder_id, files, uploaded)
+        if error:
+            logging.error("❌ %s", error)
+            return jsonify({"error": error}), 400
+
+        # One job per session at a time: a second one would share its folder
+        # and the earlier job's final status would overwrite the new one
+        folder_path = os.path.join(BASE_DIR, session_folder_name(session_id))
+        ensure_dir(folder_path)
+        if not claim_session(folder_path):
+            return jsonify({"error": f"A job for {session_id} is already queued or running"}), 409
+
+        try:
+            # save the multipart uploads now that session_id and names are known safe
+            for f, dest_path in uploads:
+                ensure_dir(os.path.dirname(dest_path))
+                f.save(dest_path)
+
+            # Record the job as queued before submitting, so the status URL
+            # works while it waits in the backlog
+            write_job_status(folder_path, "queued")
+
+            # Submit background processing job
+            job = submit_job(run_market_gap_job, session_id, email, files, folder_id)
+        except BaseException:
+            release_session(folder_path)
+            raise
+        if job is None:
+            logging.warning("⏳ Job backlog full, rejecting %s", session_id)
+            write_job_status(folder_path, "rejected", error="Server busy, retry later")
+            release_session(folder_path)
+            return jsonify({"error": "Server busy, retry later"}), 503
         logging.info(
             f"🚀 Started Market GAP processing for {session_id} with {len(files)} files, uploading to Drive folder ID: {folder_id}"
         )
 
-        return jsonify({"message": f"Market GAP analysis started for {session_id}"}), 202
+        status_url = f"/jobs/{session_id}"
+        response = jsonify({
+            "message": f"Market GAP analysis started for {session_id}",
+            "status_url": status_url
+        })
+        response.headers["Location"] = status_url
+        return response, 202
 
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH
+        raise
     except Exception:
         logging.exception("🔥 Failed to initiate Market GAP analysis")
         return jsonify({"error": "Internal server error"}), 500
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
+    logging.warning(
+        "⚠️ Running the Flask development server; in production use "
+        "'gunicorn -c gunicorn_conf.py market_gap_app:app'"
+    )
     logging.info(f"🚦 Starting Market GAP API on port {port}")
-    app.run(host="0.0.0.0", port=port)
+    app.run(host="0.0.0.0", port=port, threaded=True)
@@ -1,12 +1,29 @@
 import os
-import json
+import logging
+import functools
+from collections import Counter
+from itertools import islice
+import threading
+import multiprocessing
 import pandas as pd
-import requests
+from pandas.io.parsers import TextParser
 import openai
-import traceback
-from datetime import date
+import orjson
+from openpyxl import load_workbook
+try:
+    # Rust xlsx reader; the openpyxl loader is used when it is not installed
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, time
 from visualization import generate_visual_charts
-from drive_utils import download_sheet_as_xlsx, upload_to_drive
+from drive_utils import (
+    post_session, ensure_dir, iter_sheet_downloads, download_to_file, upload_to_drive,
+    upload_files_to_drive
+)
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 REPORTS_URL = os.getenv(
@@ -15,54 +32,176 @@ REPORTS_URL = os.getenv(
 )
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-# Insight extraction
+# Worker processes for workbook parsing and chart rendering (both pure Python
+# and GIL-bound); 0 runs them on the job thread. Off by default to keep memory low.
+PARSE_PROCESSES = int(os.getenv("MARKET_GAP_PARSE_PROCESSES", 0))
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """Return the shared parsing/rendering process pool, or None when disabled."""
+    global _parse_pool
+    if PARSE_PROCESSES <= 0:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # 'spawn' because jobs run on threads of the web server process
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+    return _parse_pool
 
-def extract_insights(local_files):
-    hw_insights = {"obsolete": [], "recommendations": [], "tier_counts": {}}
-    sw_insights = {"obsolete": [], "recommendations": [], "tier_counts": {}}
 
-    for f in local_files:
-        name = f['file_name'].lower()
-        path = f['local_path']
-        if not path.lower().endswith('.xlsx'):
-            continue
+def _cell_value(v):
+    """
+    Convert a cell the way pd.read_excel's readers do: '' for blanks, ints
+    for whole floats and datetimes for date cells (calamine yields dates).
+    """
+    if v is None:
+        return ''
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    if type(v) is date:
+        return datetime.combine(v, time())
+    return v
+
+
+def _frame(rows, keep):
+    """
+    Build a DataFrame from a header row and data rows with the parser
+    pd.read_excel uses, so the frames match it: trailing blank rows and
+    columns are trimmed, blank rows inside the sheet are kept, and column
+    types are inferred (numbers stored as text become numeric).
+    """
+    header = [_cell_value(h) for h in next(rows, ())]
+    positions = [i for i, h in enumerate(header) if keep is None or keep(i, h)]
+    data = [[header[i] for i in positions]]
+    for row in rows:
+        data.append([_cell_value(row[i]) if i < len(row) else '' for i in positions])
+
+    # Drop trailing blank rows, then trailing columns that are blank throughout
+    filled = [max((j + 1 for j, v in enumerate(r) if v != ''), default=0) for r in data]
+    while filled and not filled[-1]:
+        filled.pop()
+    width = max(filled, default=0)
+    data = [r[:width] for r in data[:len(filled)]]
+    if not width:
+        return pd.DataFrame()
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+
+def load_sheet(path, keep=None):
+    """
+    Load the first sheet of an .xlsx workbook. Uses python-calamine when
+    installed and able to read the file, otherwise streams rows with
+    openpyxl in read-only mode.
+    keep(index, header) selects the columns to load; all columns by default.
+    """
+    if CalamineWorkbook is not None:
         try:
-            df = pd.read_excel(path, engine='openpyxl')
+            sheet = CalamineWorkbook.from_path(path).get_sheet_by_index(0)
+            rows = sheet.to_python(skip_empty_area=False)
         except Exception:
-            continue
-
-        cols = {c.lower(): c for c in df.columns}
-        obsolete = []
-        if 'lifecycle status' in cols:
-            obsolete = df[
-                df[cols['lifecycle status']].astype(str).str.lower() == 'obsolete'
-            ].iloc[:, 0].astype(str).tolist()
-        recommendations = []
-        if 'recommendation' in cols:
-            recommendations = (
-                df[cols['recommendation']]
-                .dropna()
-                .astype(str)
-                .tolist()
-            )
-        tier_counts = {}
-        if 'tier' in cols:
-            tier_counts = df[cols['tier']].value_counts().to_dict()
-
-        insights = {
-            'obsolete': obsolete,
-            'recommendations': recommendations,
-            'tier_counts': tier_counts
-        }
-        if 'hw' in name:
-            hw_insights = insights
-        elif 'sw' in name:
-            sw_insights = insights
+            # Some non-standard workbooks only open with openpyxl
+            logger.warning("calamine could not read %s; falling back to openpyxl", path, exc_info=True)
+        else:
+            return _frame(iter(rows), keep)
+
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        return _frame(wb.worksheets[0].iter_rows(values_only=True), keep)
+    finally:
+        # Read-only workbooks keep the zip file open until closed
+        wb.close()
+
+
+# Software inventory columns (lower-cased) used downstream, besides the first
+# (item name) column. Hardware inventories are loaded in full: the hardware
+# gap narrative samples whole rows.
+KEEP = frozenset({
+    'lifecycle status', 'recommendation', 'tier',
+    'category', 'tier total score', 'license status',
+})
 
-    return hw_insights, sw_insights
+
+def _is_kept_column(i, header):
+    return i == 0 or (isinstance(header, str) and header.strip().lower() in KEEP)
+
+
+def read_workbook(path, kind=None):
+    """
+    Load the first sheet of an .xlsx workbook. Software ('sw') inventories
+    keep only the KEEP columns; everything else keeps every column.
+    """
+    return load_sheet(path, keep=_is_kept_column if kind == 'sw' else None)
+
+# Insight extraction
+
+def count_values(series):
+    """
+    Count non-null values, most common first, as a plain dict.
+    Counter over the raw values skips building and sorting a pandas Series.
+    """
+    return dict(Counter(series.dropna().tolist()).most_common())
+
+
+# Distinct recommendations kept per inventory
+MAX_RECOMMENDATIONS = 50
+
+
+def extract_insights(frames):
+    """
+    Compute obsolete items, recommendations and tier counts from the
+    already-loaded inventories, frames = {'hw': hw_df, 'sw': sw_df}.
+    Also returns the Tier/Count chart frames built from the same counts.
+    """
+    hw_insights = _insights(frames['hw'])
+    sw_insights = _insights(frames['sw'])
+    chart_frames = {
+        'hardware_insights': _tier_frame(hw_insights['tier_counts']),
+        'software_insights': _tier_frame(sw_insights['tier_counts']),
+    }
+    return hw_insights, sw_insights, chart_frames
+
+
+def _tier_frame(tier_counts):
+    return pd.DataFrame({'Tier': list(tier_counts), 'Count': list(tier_counts.values())})
+
+
+def _insights(df):
+    insights = {'obsolete': [], 'recommendations': [], 'tier_counts': {}}
+    if df.empty:
+        return insights
+
+    lc = {str(c).lower(): c for c in df.columns}.get
+    life, rec, tier = lc('lifecycle status'), lc('recommendation'), lc('tier')
+    if life is not None:
+        # Compare the few distinct categories, then match rows by integer code
+        status = df[life].astype('category')
+        obsolete_codes = [
+            i for i, c in enumerate(status.cat.categories)
+            if str(c).casefold() == 'obsolete'
+        ]
+        mask = status.cat.codes.isin(obsolete_codes)
+        # Select only the first column rather than copying every matching row
+        insights['obsolete'] = (
+            df.loc[mask, df.columns[0]].dropna().astype(str).drop_duplicates().tolist()
+        )
+    if rec is not None:
+        # Distinct recommendations, most frequent first
+        counts = count_values(df[rec].dropna().astype(str))
+        insights['recommendations'] = list(islice(counts, MAX_RECOMMENDATIONS))
+    if tier is not None:
+        insights['tier_counts'] = count_values(df[tier])
+    return insights
 
 # Section builders
 
+# Max inventory rows sent to OpenAI per section
+SAMPLE_ROWS = 100
+
 def build_executive_summary(hw_df, sw_df):
     return {"text": f"Analyzed {len(hw_df)} hardware items and {len(sw_df)} software items."}
 
@@ -76,7 +215,7 @@ def build_section_2_current_state_overview(hw_df, sw_df):
     )
     healthy_devices = int((scores >= 75).sum())
     compliant_licenses = int(
-        (sw_df.get("License Status", pd.Series()) != "Expired").sum()
+        sw_df.get("License Status", pd.Series()).ne("Expired").sum()
     )
     return {
         "total_devices": total_devices,
@@ -86,26 +225,83 @@ def build_section_2_current_state_overview(hw_df, sw_df):
     }
 
 
+def _records(df):
+    """Row dicts built from per-column lists; faster than to_dict('records')."""
+    cols = df.columns.tolist()
+    values = [col.tolist() for _, col in df.items()]
+    return [dict(zip(cols, row)) for row in zip(*values)]
+
+
 def build_section_3_hardware_gap_analysis(hw_df):
-    return {"hardware_items": hw_df.to_dict(orient="records")}
+    # A sample is enough for the narrative; skip columns that are empty in it
+    sample = hw_df.head(SAMPLE_ROWS).dropna(axis=1, how="all")
+    return {"hardware_items": _records(sample)}
 
 
 def build_section_4_software_gap_analysis(sw_df):
-    counts = sw_df.get("Category", pd.Series()).value_counts().to_dict()
+    counts = count_values(sw_df.get("Category", pd.Series()))
     return {"software_gap_analysis": counts}
 
 
 def build_section_5_market_benchmarking(hw_df, sw_df):
-    dist = hw_df.get("Category", pd.Series()).value_counts().to_dict()
+    dist = count_values(hw_df.get("Category", pd.Series()))
     return {"market_benchmarking": dist}
 
 # AI narrative generator
 
+# Narratives kept in memory, keyed by section and serialized summary
+NARRATIVE_CACHE_SIZE = 256
+
+JSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# Max characters of section data sent to OpenAI
+NARRATIVE_DATA_CHARS = 10000
+
+
+def _trim(obj, limit=SAMPLE_ROWS):
+    """
+    Keep at most `limit` items of every list and dict, recursively, so
+    oversized sections are cut before serialization rather than after.
+    Dicts keep their leading items (count_values orders most common first).
+    """
+    if isinstance(obj, dict):
+        return {k: _trim(v, limit) for k, v in islice(obj.items(), limit)}
+    if isinstance(obj, (list, tuple)):
+        return [_trim(v, limit) for v in obj[:limit]]
+    return obj
+
+
+def _safe_dump(obj, limit=NARRATIVE_DATA_CHARS):
+    obj = _trim(obj)
+    # Sorted keys keep the prompt byte-identical for identical data;
+    # non-str keys (int tiers) are stringified before sorting
+    raw = orjson.dumps(obj, default=str, option=JSON_OPTIONS).decode()
+    if len(raw) > limit:
+        raw = raw[:limit] + '... (truncated)'
+    return raw
+
+
 def ai_narrative(section_name: str, summary: dict) -> str:
-    print(f"[DEBUG] ai_narrative for {section_name}", flush=True)
-    raw = json.dumps(summary)
-    if len(raw) > 10000:
-        raw = raw[:10000] + '... (truncated)'
+    logger.debug("ai_narrative for %s", section_name)
+    raw = _safe_dump(summary)
+    try:
+        return _generate_narrative(section_name, raw)
+    except openai.RateLimitError:
+        # Shorter fallback narrative; deliberately not cached, so the next
+        # run over the same data gets gpt-4o-mini again once the limit clears
+        return _complete(section_name, raw, model="gpt-3.5-turbo", max_tokens=300)
+
+
+@functools.lru_cache(maxsize=NARRATIVE_CACHE_SIZE)
+def _generate_narrative(section_name: str, raw: str) -> str:
+    """
+    Call OpenAI for one section. Cached on the exact serialized prompt data,
+    so re-runs and retries over unchanged inputs skip the model call.
+    """
+    return _complete(section_name, raw, model="gpt-4o-mini", max_tokens=500)
+
+
+def _complete(section_name: str, raw: str, model: str, max_tokens: int) -> str:
     user_content = f"Section: {section_name}\nData: {raw}"
 
     messages = [
@@ -116,77 +312,116 @@ def ai_narrative(section_name: str, summary: dict) -> str:
         {"role": "user", "content": user_content}
     ]
 
-    try:
-        resp = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.3,
-            max_tokens=500
-        )
-    except openai.RateLimitError:
-        resp = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.3,
-            max_tokens=300
-        )
+    resp = openai.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=max_tokens
+    )
     return resp.choices[0].message.content.strip()
 
 # Main processing function
 
+def inventory_kind(file_name):
+    """'hw' or 'sw' for an inventory file, by name; None for files not analyzed."""
+    name = file_name.lower()
+    return 'hw' if 'hw' in name else 'sw' if 'sw' in name else None
+
+
 def process_market_gap(session_id, email, files, local_path, folder_id=None):
     """
     Full Market GAP Analysis: downloads files, extracts insights, generates charts,
     uses OpenAI to create narratives for each section, then calls report generator.
     """
     try:
-        os.makedirs(local_path, exist_ok=True)
-        local_files = []
+        ensure_dir(local_path)
         hw_df = pd.DataFrame()
         sw_df = pd.DataFrame()
 
-        # 1. Download input files and build DataFrames
-        for f in files:
-            dest = download_sheet_as_xlsx(f['drive_url'], local_path)
-            local_files.append({'file_name': f['file_name'], 'local_path': dest})
-            name_lower = f['file_name'].lower()
-            if 'hw' in name_lower:
-                hw_df = pd.read_excel(dest, engine='openpyxl')
-            elif 'sw' in name_lower:
-                sw_df = pd.read_excel(dest, engine='openpyxl')
+        # 1. Download input files in parallel, parsing each one as it arrives
+        # (files uploaded via multipart are already staged at local_path)
+        staged = [f.get('local_path') for f in files]
+        frames = [None] * len(files)
+        parse_pool = get_parse_pool()
+
+        # Classify by file name once; only the last hw and last sw file
+        # listed are used, so no other workbook is parsed
+        last = {}
+        for i, f in enumerate(files):
+            kind = inventory_kind(f['file_name'])
+            if kind:
+                last[kind] = i
+        to_parse = {i: kind for kind, i in last.items()}
+
+        def ingest(i, dest):
+            staged[i] = dest
+            if i in to_parse:
+                if parse_pool:
+                    frames[i] = parse_pool.submit(read_workbook, dest, to_parse[i])
+                else:
+                    frames[i] = read_workbook(dest, to_parse[i])
+
+        for i, dest in enumerate(staged):
+            if dest:
+                ingest(i, dest)
+        remote = [i for i, dest in enumerate(staged) if not dest]
+        for j, dest in iter_sheet_downloads([files[i]['drive_url'] for i in remote], local_path):
+            ingest(remote[j], dest)
+
+        local_files = [
+            {'file_name': f['file_name'], 'local_path': dest}
+            for f, dest in zip(files, staged)
+        ]
+        parsed = {
+            kind: frames[i].result() if isinstance(frames[i], Future) else frames[i]
+            for kind, i in last.items()
+        }
+        hw_df = parsed.get('hw', hw_df)
+        sw_df = parsed.get('sw', sw_df)
 
         # 2. Extract insights
-        hw_insights, sw_insights = extract_insights(local_files)
-
-        # 3. Generate and upload charts
-        data_frames = {
-            'hardware_insights': pd.DataFrame(
-                list(hw_insights['tier_counts'].items()),
-                columns=['Tier', 'Count']
-            ),
-            'software_insights': pd.DataFrame(
-                list(sw_insights['tier_counts'].items()),
-                columns=['Tier', 'Count']
+        hw_insights, sw_insights, data_frames = extract_insights({'hw': hw_df, 'sw': sw_df})
+
+        # 3. Generate and upload charts, rendered in memory (no disk round trip);
+        # inventories without tier counts get no chart, and with none at all
+        # the chart stage (matplotlib, Drive) is skipped entirely
+        data_frames = {k: df for k, df in data_frames.items() if not df.empty}
+        if parse_pool and len(data_frames) > 1:
+            # One chart set per inventory, rendered in parallel processes
+            rendered = [
+                parse_pool.submit(generate_visual_charts, {k: df})
+                for k, df in data_frames.items()
+            ]
+            charts = {k: buf for fut in rendered for k, buf in fut.result().items()}
+        else:
+            charts = generate_visual_charts(data_frames) if data_frames else {}
+        chart_keys = list(charts)
+
+        # Chart uploads run in the background while the narratives are generated
+        # (one worker for the uploads, one per narrative section)
+        with ThreadPoolExecutor(max_workers=6) as ex:
+            chart_upload = ex.submit(
+                upload_files_to_drive,
+                [charts[k] for k in chart_keys],
+                folder_id
             )
-        }
-        chart_dir = os.path.join(local_path, 'market_gap_charts')
-        os.makedirs(chart_dir, exist_ok=True)
-        chart_paths = generate_visual_charts(data_frames, chart_dir)
-        chart_ids = {k: upload_to_drive(path, folder_id) for k, path in chart_paths.items()}
 
-        chart_urls = {k: f"https://drive.google.com/file/d/{fid}/view?usp=drivesdk" for k, fid in chart_ids.items()}
+            # 4. Build section summaries
+            summaries = {
+                'executive_summary': build_executive_summary(hw_df, sw_df),
+                'current_state_overview': build_section_2_current_state_overview(hw_df, sw_df),
+                'hardware_gap_analysis': build_section_3_hardware_gap_analysis(hw_df),
+                'software_gap_analysis': build_section_4_software_gap_analysis(sw_df),
+                'market_benchmarking': build_section_5_market_benchmarking(hw_df, sw_df)
+            }
 
-        # 4. Build section summaries
-        summaries = {
-            'executive_summary': build_executive_summary(hw_df, sw_df),
-            'current_state_overview': build_section_2_current_state_overview(hw_df, sw_df),
-            'hardware_gap_analysis': build_section_3_hardware_gap_analysis(hw_df),
-            'software_gap_analysis': build_section_4_software_gap_analysis(sw_df),
-            'market_benchmarking': build_section_5_market_benchmarking(hw_df, sw_df)
-        }
+            # 5. Generate narratives via OpenAI, all sections concurrently
+            narratives = {k: ex.submit(ai_narrative, k, v) for k, v in summaries.items()}
+            sections = {k: fut.result() for k, fut in narratives.items()}
+
+            chart_ids = dict(zip(chart_keys, chart_upload.result()))
 
-        # 5. Generate narratives via OpenAI
-        sections = {k: ai_narrative(k, summaries[k]) for k in summaries}
+        chart_urls = {k: f"https://drive.google.com/file/d/{fid}/view?usp=drivesdk" for k, fid in chart_ids.items()}
 
         # 6. Assemble payload
         payload = {
@@ -197,33 +432,34 @@ def process_market_gap(session_id, email, files, local_path, folder_id=None):
             'charts': chart_urls,
             'appendices': [lf['file_name'] for lf in local_files]
         }
-        print(f"[DEBUG] Calling report generator with payload keys: {list(payload.keys())}", flush=True)
+        logger.debug("Calling report generator with payload keys: %s", list(payload))
 
         # 7. Call report generator service
-        resp = requests.post(
+        resp = post_session.post(
             f"{REPORTS_URL}/generate_market_reports",
-            json=payload,
+            data=orjson.dumps(payload, default=str, option=orjson.OPT_SERIALIZE_NUMPY),
+            headers={'Content-Type': 'application/json'},
             timeout=120
         )
         resp.raise_for_status()
-        result = resp.json()
+        result = orjson.loads(resp.content)
 
-        # 8. Download & upload final reports
-        for url in result.get('report_urls', []):
+        # 8. Download & upload final reports, all reports concurrently
+        def transfer_report(url):
             try:
-                r = requests.get(url, timeout=60)
-                r.raise_for_status()
                 fn = os.path.basename(url)
-                dest = os.path.join(local_path, fn)
-                with open(dest, 'wb') as fh:
-                    fh.write(r.content)
+                dest = download_to_file(url, os.path.join(local_path, fn), timeout=60)
                 upload_to_drive(dest, folder_id)
-            except Exception as err:
-                print(f"❌ Failed to download/upload {url}: {err}")
+            except Exception:
+                logger.exception("❌ Failed to download/upload %s", url)
+
+        report_urls = result.get('report_urls', [])
+        if report_urls:
+            with ThreadPoolExecutor(max_workers=min(4, len(report_urls))) as ex:
+                list(ex.map(transfer_report, report_urls))
 
         return result
 
     except Exception as e:
-        print(f"🔥 process_market_gap failed for {session_id}: {e}")
-        traceback.print_exc()
+        logger.exception("🔥 process_market_gap failed for %s", session_id)
         return {'error': str(e)}
@@ -1,9 +1,143 @@
+import io
 import os
-import matplotlib.pyplot as plt
-import pandas as pd
+import functools
+from collections import Counter
 
+# Resolution for saved chart images
+CHART_DPI = 90
+# Maximum zlib level for the chart PNGs: about 8% smaller than the default
+# for flat-colour charts at negligible cost for images this size
+PNG_OPTIONS = {'compress_level': 9}
 
-def generate_visual_charts(data_frames: dict, output_dir: str) -> dict:
+
+@functools.cache
+def _figure_types():
+    """
+    Import matplotlib on first use and pin the chart style once.
+    Charts are drawn on Agg canvases directly, without pyplot: no GUI
+    backend probing and no global figure registry shared across job threads.
+    """
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    matplotlib.rcParams.update({
+        'figure.figsize': (6.4, 4.8),
+        'figure.dpi': CHART_DPI,
+        'savefig.dpi': CHART_DPI,
+        'savefig.format': 'png',
+        # Figures are never registered with pyplot, so its open-figure
+        # warning can only be noise
+        'figure.max_open_warning': 0,
+    })
+    return Figure, FigureCanvasAgg
+
+
+def warm_up():
+    """
+    Load matplotlib and its font cache by drawing a throwaway chart, so the
+    first real chart does not pay for it. Call once in the server parent
+    process (before workers fork).
+    """
+    fig = _new_figure()
+    _fresh_axes(fig).set_title('warm-up')
+    fig.savefig(io.BytesIO(), format='png')
+
+
+def _save(fig, output_dir, file_name):
+    """Write fig as PNG to output_dir, or to a named BytesIO when output_dir is None."""
+    if output_dir is None:
+        target = io.BytesIO()
+        target.name = file_name
+    else:
+        target = os.path.join(output_dir, file_name)
+    fig.savefig(target, format='png', dpi=CHART_DPI, pil_kwargs=PNG_OPTIONS)
+    if output_dir is None:
+        target.seek(0)
+    return target
+
+
+def _new_figure():
+    Figure, FigureCanvasAgg = _figure_types()
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _fresh_axes(fig):
+    """Reset the shared figure for the next chart instead of building a new one."""
+    fig.clear()
+    return fig.add_subplot(111)
+
+
+def _value_counts(series):
+    """Distinct non-null values and their counts, most common first."""
+    pairs = Counter(series.dropna().tolist()).most_common()
+    return [v for v, _ in pairs], [n for _, n in pairs]
+
+
+def _bar(ax, labels, heights):
+    """Bar chart drawn directly on ax, laid out like pandas' plot(kind='bar')."""
+    positions = range(len(labels))
+    ax.bar(positions, heights, width=0.5)
+    ax.set_xticks(positions)
+    ax.set_xticklabels([str(v) for v in labels], rotation=90)
+
+
+def _render_tier_pie(df, ax, base):
+    # Size slices by the Count column when the tiers are pre-counted
+    if 'Count' in df.columns:
+        labels, sizes = df['Tier'].tolist(), df['Count'].tolist()
+    else:
+        labels, sizes = _value_counts(df['Tier'])
+    ax.pie(sizes, labels=[str(v) for v in labels], autopct='%1.1f%%')
+    ax.set_ylabel('')
+    ax.set_title(f"{base} Tier Distribution")
+
+
+def _render_status_bar(df, ax, base):
+    _bar(ax, *_value_counts(df['Status']))
+    ax.set_xlabel('Status')
+    ax.set_ylabel('Count')
+    ax.set_title(f"{base} Status Counts")
+
+
+def _render_value_bar(df, col, ax, base):
+    _bar(ax, df.index.tolist(), df[col].to_numpy())
+    ax.set_xlabel(col)
+    ax.set_ylabel('Value')
+    ax.set_title(f"{base} {col}")
+
+
+def _render_distribution(df, col, ax, base):
+    _bar(ax, *_value_counts(df[col]))
+    ax.set_xlabel(col)
+    ax.set_ylabel('Count')
+    ax.set_title(f"{base} {col} Distribution")
+
+
+def _chart_specs(df):
+    """
+    List the charts for one DataFrame as (key suffix, file suffix, render)
+    tuples, in drawing order; render(ax, base) draws onto a cleared axes.
+    """
+    numeric_cols = df.select_dtypes(include='number').columns
+    specs = []
+    if 'Tier' in df.columns:
+        specs.append(('tier', 'tier_pie', functools.partial(_render_tier_pie, df)))
+    if 'Status' in df.columns:
+        specs.append(('status', 'status_bar', functools.partial(_render_status_bar, df)))
+    for col in numeric_cols:
+        if isinstance(col, str) and ('Obsolescence' in col or 'Gap' in col):
+            specs.append((col, f"{col}_bar", functools.partial(_render_value_bar, df, col)))
+    # Fall back to the first numeric column's distribution
+    if not specs and len(numeric_cols) > 0:
+        col = numeric_cols[0]
+        specs.append((col, f"{col}_dist", functools.partial(_render_distribution, df, col)))
+    return specs
+
+
+def generate_visual_charts(data_frames: dict, output_dir: str = None) -> dict:
     """
     Generate market-gap-specific charts for each DataFrame.
     - If DataFrame has a 'Tier' column, create a pie chart of tier distribution.
@@ -12,73 +146,27 @@ def generate_visual_charts(data_frames: dict, output_dir: str) -> dict:
     - Otherwise, default to the first numeric column's value-count bar chart.
 
     Saves each chart as a PNG in output_dir and returns a mapping of
-    chart keys to their file paths.
+    chart keys to their file paths. Without output_dir, charts are rendered
+    in memory and returned as BytesIO buffers named after the file.
 
     Args:
       data_frames: dict mapping filenames to pandas DataFrames
-      output_dir: directory path where charts will be saved
+      output_dir: directory path where charts will be saved, or None
 
     Returns:
-      charts: dict mapping chart keys to local image paths
+      charts: dict mapping chart keys to local image paths or PNG buffers
     """
     charts = {}
-    os.makedirs(output_dir, exist_ok=True)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    # One figure per call, reused for every chart (not shared across threads)
+    fig = _new_figure() if data_frames else None
 
     for name, df in data_frames.items():
         base = os.path.splitext(name)[0]
-        # 1. Tier pie chart
-        if 'Tier' in df.columns:
-            counts = df['Tier'].value_counts()
-            fig, ax = plt.subplots()
-            counts.plot.pie(ax=ax, autopct='%1.1f%%')
-            ax.set_ylabel('')
-            ax.set_title(f"{base} Tier Distribution")
-            path = os.path.join(output_dir, f"{base}_tier_pie.png")
-            fig.savefig(path)
-            plt.close(fig)
-            charts[f"{base}_tier"] = path
-
-        # 2. Status bar chart
-        if 'Status' in df.columns:
-            counts = df['Status'].value_counts()
-            fig, ax = plt.subplots()
-            counts.plot(kind='bar', ax=ax)
-            ax.set_xlabel('Status')
-            ax.set_ylabel('Count')
-            ax.set_title(f"{base} Status Counts")
-            path = os.path.join(output_dir, f"{base}_status_bar.png")
-            fig.savefig(path)
-            plt.close(fig)
-            charts[f"{base}_status"] = path
-
-        # 3. Obsolescence or Gap columns
-        for col in df.columns:
-            if 'Obsolescence' in col or 'Gap' in col:
-                if pd.api.types.is_numeric_dtype(df[col]):
-                    fig, ax = plt.subplots()
-                    df[col].plot(kind='bar', ax=ax)
-                    ax.set_xlabel(col)
-                    ax.set_ylabel('Value')
-                    ax.set_title(f"{base} {col}")
-                    path = os.path.join(output_dir, f"{base}_{col}_bar.png")
-                    fig.savefig(path)
-                    plt.close(fig)
-                    charts[f"{base}_{col}"] = path
-
-        # 4. Default numeric column
-        if not any(key.startswith(base) for key in charts):
-            numeric_cols = df.select_dtypes(include='number').columns
-            if len(numeric_cols) > 0:
-                col = numeric_cols[0]
-                counts = df[col].value_counts()
-                fig, ax = plt.subplots()
-                counts.plot(kind='bar', ax=ax)
-                ax.set_xlabel(col)
-                ax.set_ylabel('Count')
-                ax.set_title(f"{base} {col} Distribution")
-                path = os.path.join(output_dir, f"{base}_{col}_dist.png")
-                fig.savefig(path)
-                plt.close(fig)
-                charts[f"{base}_{col}"] = path
+        for key, suffix, render in _chart_specs(df):
+            ax = _fresh_axes(fig)
+            render(ax, base)
+            charts[f"{base}_{key}"] = _save(fig, output_dir, f"{base}_{suffix}.png")
 
     return charts